@@ -2,24 +2,43 @@ from __future__ import annotations
 
 import os
 import re
-import json
-from typing import TypeAlias, Iterable, TypedDict, Literal, Any, TypeVar
+import queue
+import signal
+import mimetypes
+import threading
+import zlib
+from typing import TypeAlias, Iterable, Iterator, TypedDict, Literal, Any, TypeVar
 from pathlib import Path
-from functools import wraps
+from datetime import datetime, timezone
+from dataclasses import dataclass
+from collections import deque
+from functools import wraps, lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 import click
-from flask import Flask, send_from_directory, Response as FlaskResponse, render_template
+import msgspec
+import orjson
+from flask import (
+    Flask,
+    request,
+    Response as FlaskResponse,
+    render_template,
+    stream_with_context,
+)
 from PIL import Image
-from pydantic import BaseModel, Field
 from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
 
 
 BASE_DIR = Path(__file__).absolute().parent
 DEFAULT_IMAGE_DIR = "images"
 DEFAULT_THUMBNAIL_SIZE = (128, 128)
 V2_API_PREFIX = "/evergreen-assets/backgroundimages"
-ACCEPTED_SUFFIXES = ("png", "jpg", "jpeg", "gif")
+ACCEPTED_SUFFIXES = frozenset(("png", "jpg", "jpeg", "gif"))
 EXTENSION_MAPPING = {"jpeg": "jpg", "gif": "jpg"}
+EXTENSION_SUFFIXES = {ext: f".{new_ext}" for ext, new_ext in EXTENSION_MAPPING.items()}
+EXTENSION_RE = re.compile(r"(?<=.)\.([A-Za-z0-9]+)$")
 
 
 if xdg_conf_dir := os.environ.get("XDG_CONFIG_DIR"):
@@ -33,11 +52,13 @@ else:
     CACHE_BASE_DIR = Path.home() / ".cache"
 
 DEFAULT_CONFIG_FILE = CONF_BASE_DIR / "teamster" / "config.json"
+MANIFEST_FILE_NAME = ".manifest.json"
 DEFAULT_CACHE_DIR = CACHE_BASE_DIR / "teamster"
 TEAMS_CONFIG_FILE = CONF_BASE_DIR / "teams-for-linux" / "config.json"
 
 E = TypeVar("E", bound=HTTPException)
 Response: TypeAlias = FlaskResponse | str
+ThumbnailJob: TypeAlias = tuple[Path, Path, tuple[int, int]]
 
 
 class ImageEntry(TypedDict):
@@ -48,21 +69,21 @@ class ImageEntry(TypedDict):
     thumb_src: str
 
 
-class Config(BaseModel):
-    image_dir: Path = Field(default=BASE_DIR / DEFAULT_IMAGE_DIR)
-    thumbnail_dir: Path = Field(default=DEFAULT_CACHE_DIR)
-    thumbnail_size: tuple[int, int] = Field(default=DEFAULT_THUMBNAIL_SIZE)
-    listen_address: str = Field(default="::1")
-    port: int = Field(default=6789)
-    teams_version: Literal[1, 2] = Field(default=2)
-    debug: bool = Field(default=False)
-    fetch_interval: int = Field(default=60)
-    ignore_teams_images: bool = Field(default=True)
-    update_teams_config: bool = Field(default=False)
-    notify: bool = Field(default=True)
-
-    def __init__(self, **data: Any) -> None:
-        super().__init__(**data)
+@dataclass
+class Config:
+    image_dir: Path = BASE_DIR / DEFAULT_IMAGE_DIR
+    thumbnail_dir: Path = DEFAULT_CACHE_DIR
+    thumbnail_size: tuple[int, int] = DEFAULT_THUMBNAIL_SIZE
+    listen_address: str = "::1"
+    port: int = 6789
+    teams_version: Literal[1, 2] = 2
+    debug: bool = False
+    fetch_interval: int = 60
+    ignore_teams_images: bool = True
+    update_teams_config: bool = False
+    notify: bool = True
+
+    def __post_init__(self) -> None:
         self.image_dir = (
             self.image_dir if self.image_dir.is_absolute() else BASE_DIR / self.image_dir
         )
@@ -71,16 +92,16 @@ class Config(BaseModel):
             if self.thumbnail_dir.is_absolute()
             else BASE_DIR / self.thumbnail_dir
         )
+        self._base_dirs = {"images": self.image_dir, "thumbnails": self.thumbnail_dir}
+        self._image_dir_str = str(self.image_dir) + os.sep
+        self._thumbnail_dir_str = str(self.thumbnail_dir) + os.sep
+        self._base_dir_strs = {
+            "images": self._image_dir_str,
+            "thumbnails": self._thumbnail_dir_str,
+        }
 
     def get_base_dir(self, prefix: str) -> Path:
-        if prefix == "images":
-            return self.image_dir
-        elif prefix == "thumbnails":
-            return self.thumbnail_dir
-        else:
-            raise KeyError(
-                f"bad value for prefix. exptected: 'images' or 'thumbnails'. got: {prefix}"
-            )
+        return self._base_dirs[prefix]
 
 
 class Notifier:
@@ -104,79 +125,285 @@ class Notifier:
                 ),
                 self.item,
             )
+            self._queue: queue.Queue[tuple[str, str, int, int] | None] = queue.Queue()
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
 
             import atexit
 
-            atexit.register(self.send, "web server stoppinng…")
+            atexit.register(self._shutdown)
+
+    def _drain(self) -> None:
+        while (item := self._queue.get()) is not None:
+            msg, title, urgency, timeout = item
+            try:
+                self._sender.Notify(
+                    "", 0, "", title, msg, [], {"urgency": urgency}, timeout
+                )
+            except Exception as e:
+                print(f"could not send notification: {e}")
+
+    def _shutdown(self) -> None:
+        self.send("web server stoppinng…")
+        self._queue.put(None)
+        self._thread.join(timeout=5)
 
     def send(
         self, msg: str, title: str = "Teamster", urgency: int = 1, timeout: int = 3000
     ) -> None:
         if self._enabled:
-            self._sender.Notify("", 0, "", title, msg, [], {"urgency": urgency}, timeout)
+            self._queue.put_nowait((msg, title, urgency, timeout))
+
+
+def _dec_hook(type_: type, obj: Any) -> Any:
+    if type_ is Path:
+        return Path(obj)
+    raise NotImplementedError(f"cannot decode objects of type {type_}")
 
 
 def import_config(path: Path) -> Config:
-    text = path.read_text()
-    return Config.model_validate_json(text)
+    return msgspec.json.decode(path.read_bytes(), type=Config, dec_hook=_dec_hook)
 
 
 def create_thumbnail(img: Path, thumb: Path, size: tuple[int, int]) -> None:
     print(f"creating thumbnail thumb {thumb} from img {img}")
-    if not thumb.parent.exists():
-        thumb.parent.mkdir()
     with Image.open(img) as f:
         try:
-            f.thumbnail(size)
-            f.save(thumb)
+            im: Image.Image = f
+            if f.format == "JPEG":
+                f.draft("RGB", size)
+            elif f.mode != "P" and (factor := max(f.size) // max(size)) > 1:
+                im = f.reduce(factor)
+            im.thumbnail(size, Image.Resampling.LANCZOS)
+            ext = thumb.suffix.lower()
+            if ext in (".jpg", ".jpeg"):
+                im.save(thumb, optimize=True, progressive=True, quality=85)
+            elif ext == ".png":
+                im.save(thumb, optimize=True)
+            else:
+                im.save(thumb)
         except Exception as e:
             raise IOError(f"could not create thumbnail for {img}") from e
 
 
-def get_file_listing(
-    config: Config, base_dir: Path | None = None
-) -> Iterable[ImageEntry]:
-    base = base_dir or config.image_dir
-    for p in base.iterdir():
-        if p.is_dir():
-            yield from get_file_listing(config, p)
+_manifest: dict[str, float] | None = None
 
-        else:
-            img = p.relative_to(config.image_dir)
-            ext = img.suffix.replace(".", "").lower()
-            if ext not in ACCEPTED_SUFFIXES:
-                continue
-            new_ext = EXTENSION_MAPPING.get(ext)
 
-            thumb = config.thumbnail_dir / img
-            if not thumb.exists():
-                create_thumbnail(p, thumb, config.thumbnail_size)
+def load_manifest(config: Config) -> dict[str, float]:
+    global _manifest
+    if _manifest is None:
+        try:
+            _manifest = orjson.loads(
+                (config.thumbnail_dir / MANIFEST_FILE_NAME).read_bytes()
+            )
+        except (OSError, orjson.JSONDecodeError):
+            _manifest = {}
+
+        import atexit
+
+        atexit.register(save_manifest, config)
+    return _manifest
+
+
+def save_manifest(config: Config) -> None:
+    if _manifest is not None and config.thumbnail_dir.exists():
+        (config.thumbnail_dir / MANIFEST_FILE_NAME).write_bytes(orjson.dumps(_manifest))
+
+
+def create_thumbnail_worker(job: ThumbnailJob) -> None:
+    create_thumbnail(*job)
+
+
+def find_existing_thumbnails(config: Config) -> set[str]:
+    existing: set[str] = set()
+    if not config.thumbnail_dir.exists():
+        return existing
+    stack = deque([str(config.thumbnail_dir)])
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    existing.add(entry.path.removeprefix(config._thumbnail_dir_str))
+    return existing
+
+
+def find_missing_thumbnails(config: Config) -> Iterable[ThumbnailJob]:
+    manifest = load_manifest(config)
+    existing: set[str] | None = None
+    stack = deque([str(config.image_dir)])
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                m = EXTENSION_RE.search(entry.name)
+                if not m or m.group(1).lower() not in ACCEPTED_SUFFIXES:
+                    continue
+                img = entry.path.removeprefix(config._image_dir_str)
+                mtime = entry.stat().st_mtime
+                if manifest.get(img) == mtime:
+                    continue
+                if img not in manifest:
+                    if existing is None:
+                        existing = find_existing_thumbnails(config)
+                    if img in existing:
+                        manifest[img] = mtime
+                        continue
+                yield (
+                    Path(entry.path),
+                    config.thumbnail_dir / img,
+                    config.thumbnail_size,
+                )
+
+
+def mirror_image_tree(config: Config) -> None:
+    os.makedirs(config.thumbnail_dir, exist_ok=True)
+    for dirpath, _, _ in os.walk(config.image_dir):
+        rel = dirpath.removeprefix(config._image_dir_str)
+        if rel != dirpath:
+            os.makedirs(config.thumbnail_dir / rel, exist_ok=True)
+
+
+def generate_missing_thumbnails(config: Config) -> None:
+    jobs = list(find_missing_thumbnails(config))
+    if not jobs:
+        return
+    mirror_image_tree(config)
+    with ProcessPoolExecutor() as pool:
+        for _ in pool.map(create_thumbnail_worker, jobs):
+            pass
+    manifest = load_manifest(config)
+    for img_path, _, _ in jobs:
+        img = str(img_path).removeprefix(config._image_dir_str)
+        manifest[img] = img_path.stat().st_mtime
+
+
+def get_file_listing(config: Config) -> Iterable[ImageEntry]:
+    generate_missing_thumbnails(config)
+    prefix = V2_API_PREFIX if config.teams_version == 2 else ""
+    src_prefix = prefix + "/images/"
+    thumb_prefix = prefix + "/thumbnails/"
+    stack = deque([str(config.image_dir)])
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+
+                m = EXTENSION_RE.search(entry.name)
+                if not m:
+                    continue
+                ext = m.group(1).lower()
+                if ext not in ACCEPTED_SUFFIXES:
+                    continue
+                stem = entry.name[: m.start()]
+                new_ext = EXTENSION_MAPPING.get(ext)
+
+                img_name = entry.path.removeprefix(
+                    config._image_dir_str
+                ) + EXTENSION_SUFFIXES.get(ext, "")
+
+                yield {
+                    "filetype": new_ext or ext,
+                    "id": stem,
+                    "name": stem,
+                    "src": src_prefix + img_name,
+                    "thumb_src": thumb_prefix + img_name,
+                }
+
+
+_config_cache: tuple[tuple[float, int], bytes] | None = None
+_cache_dirty = threading.Event()
+_cache_dirty.set()
+
+
+def watch_image_dir(config: Config) -> bool:
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import (
+            EVENT_TYPE_CREATED,
+            EVENT_TYPE_DELETED,
+            EVENT_TYPE_MODIFIED,
+            EVENT_TYPE_MOVED,
+            FileSystemEvent,
+            FileSystemEventHandler,
+        )
+    except ModuleNotFoundError:
+        return False
+
+    mutating_events = frozenset(
+        (EVENT_TYPE_CREATED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED)
+    )
 
-            prefix = V2_API_PREFIX if config.teams_version == 2 else ""
+    class CacheInvalidator(FileSystemEventHandler):
+        def on_any_event(self, event: FileSystemEvent) -> None:
+            if event.event_type in mutating_events:
+                _cache_dirty.set()
 
-            img_name = str(img) + (f".{new_ext}" if new_ext else "")
+    observer = Observer()
+    observer.daemon = True
+    observer.schedule(CacheInvalidator(), str(config.image_dir), recursive=True)
+    observer.start()
+    return True
 
-            yield {
-                "filetype": new_ext or ext,
-                "id": img.stem,
-                "name": img.stem,
-                "src": f"{prefix}/images/{img_name}",
-                "thumb_src": f"{prefix}/thumbnails/{img_name}",
-            }
 
+def get_listing_mtime(config: Config) -> float:
+    latest = os.stat(config.image_dir).st_mtime
+    for dirpath, _, _ in os.walk(config.image_dir):
+        latest = max(latest, os.stat(dirpath).st_mtime)
+    return latest
 
-def find_file(path: Path) -> Path:
+
+def stream_config_json(config: Config, key: tuple[float, int]) -> Iterator[bytes]:
+    global _config_cache
+    _cache_dirty.clear()
+    complete = False
+    try:
+        if config.teams_version == 1:
+            head, tail = b"[", b"]"
+        else:
+            head, tail = b'{"videoBackgroundImages":[', b"]}"
+        chunks = [head]
+        yield head
+        sep = b""
+        for entry in get_file_listing(config):
+            chunk = sep + orjson.dumps(entry)
+            sep = b","
+            chunks.append(chunk)
+            yield chunk
+        chunks.append(tail)
+        yield tail
+        _config_cache = (key, b"".join(chunks))
+        complete = True
+    finally:
+        if not complete:
+            _cache_dirty.set()
+
+
+@lru_cache(maxsize=2048)
+def _resolve_file(path_str: str) -> str:
+    path = Path(path_str)
     if path.exists():
-        return path
-    return path.with_suffix("")
+        return path_str
+    return str(path.with_suffix(""))
+
+
+def find_file(path: Path) -> Path:
+    return Path(_resolve_file(str(path)))
 
 
 def create_app(config: Config, notifier: Notifier) -> Flask:
     app = Flask("teamster")
+    watching = watch_image_dir(config)
 
     def list_files(dir: Path, prefix: Literal["images", "thumbnails"]) -> Response:
         rel_dir = config.get_base_dir(prefix)
-        files = (p.relative_to(rel_dir) for p in dir.iterdir())
+        rel_dir_str = config._base_dir_strs[prefix]
+        files = [Path(e.path.removeprefix(rel_dir_str)) for e in os.scandir(dir)]
         return render_template(
             "file-listing.html", prefix=prefix, paths=files, back=dir.relative_to(rel_dir)
         )
@@ -190,8 +417,9 @@ def create_app(config: Config, notifier: Notifier) -> Flask:
 
     @app.after_request
     def add_headers(resp: FlaskResponse) -> FlaskResponse:
+        if resp.status_code == 304:
+            return resp
         resp.headers["Access-Control-Allow-Origin"] = "*"
-        resp.headers["access-control-allow-origin"] = "*"
         return resp
 
     @app.get("/")
@@ -216,21 +444,50 @@ def create_app(config: Config, notifier: Notifier) -> Flask:
             rel_dir = config.get_base_dir(prefix)
         except KeyError as e:
             raise NotFound(str(e))
-        if (dir := rel_dir / path).is_dir():
+        full_path = safe_join(str(rel_dir), path)
+        if full_path is None:
+            raise NotFound()
+        if (dir := Path(full_path)).is_dir():
             return list_files(dir, prefix=prefix)  # type: ignore[arg-type]
         else:
-            p = find_file(rel_dir / path)
-            return send_from_directory(rel_dir, p.relative_to(rel_dir))
+            p = find_file(dir)
+            try:
+                f = p.open("rb")
+            except OSError:
+                raise NotFound()
+            stat = os.fstat(f.fileno())
+            content_type = mimetypes.guess_type(p.name)[0] or "application/octet-stream"
+            response = FlaskResponse(
+                wrap_file(request.environ, f),
+                content_type=content_type,
+                direct_passthrough=True,
+            )
+            response.headers["Content-Length"] = str(stat.st_size)
+            response.last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+            response.set_etag(
+                f"{stat.st_mtime}-{stat.st_size}-{zlib.adler32(str(p).encode())}"
+            )
+            response.make_conditional(
+                request, accept_ranges=True, complete_length=stat.st_size
+            )
+            return response
 
     @app.get("/config.json")
     def serve_config_json() -> Response:
-        files = list(get_file_listing(config))
-        resp: list[ImageEntry] | dict[str, list[ImageEntry]]
-        if config.teams_version == 1:
-            resp = files
+        body: bytes | Iterator[bytes]
+        if watching:
+            if not _cache_dirty.is_set() and _config_cache is not None:
+                body = _config_cache[1]
+            else:
+                key = (0.0, config.teams_version)
+                body = stream_with_context(stream_config_json(config, key))
         else:
-            resp = {"videoBackgroundImages": files}
-        response = FlaskResponse(json.dumps(resp))
+            key = (get_listing_mtime(config), config.teams_version)
+            if _config_cache and _config_cache[0] == key:
+                body = _config_cache[1]
+            else:
+                body = stream_with_context(stream_config_json(config, key))
+        response = FlaskResponse(body)
         response.content_type = "application/json"
         return response
 
@@ -243,8 +500,7 @@ def update_config(config: Config, notifier: Notifier) -> None:
     teams_config: dict[str, Any]
 
     if TEAMS_CONFIG_FILE.exists():
-        with TEAMS_CONFIG_FILE.open("r") as f:
-            teams_config = json.load(f)
+        teams_config = orjson.loads(TEAMS_CONFIG_FILE.read_bytes())
     else:
         teams_config = {}
 
@@ -255,8 +511,7 @@ def update_config(config: Config, notifier: Notifier) -> None:
     }
 
     if new_config != teams_config:
-        with TEAMS_CONFIG_FILE.open("w") as f:
-            json.dump(new_config, f)
+        TEAMS_CONFIG_FILE.write_bytes(orjson.dumps(new_config))
         notifier.send("restart Teams app due to config change")
         print("++++++++++++++++++++++++++++++++++++++++")
         print("")
@@ -268,6 +523,8 @@ def update_config(config: Config, notifier: Notifier) -> None:
 def main(config: Config, notifier: Notifier) -> None:
     config.image_dir.mkdir(exist_ok=True)
     config.thumbnail_dir.mkdir(exist_ok=True)
+    generate_missing_thumbnails(config)
+    signal.signal(signal.SIGHUP, lambda *_: _resolve_file.cache_clear())
     create_app(config, notifier).run(
         host=config.listen_address, port=config.port, debug=config.debug
     )